@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Shared pytest fixtures for the Superset-Patchup tests
+"""
+import copy
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from superset_patchup.oauth import CustomSecurityManager
+
+
+@pytest.fixture(scope="module")
+def csm_template():
+    """
+    A CustomSecurityManager built once per module; the parent
+    SupersetSecurityManager constructor is expensive, so tests work with
+    shallow copies of this template instead of rebuilding it each time
+    """
+    return CustomSecurityManager(appbuilder=MagicMock())
+
+
+@pytest.fixture
+def csm(csm_template, monkeypatch):
+    """
+    A per-test shallow copy of the CustomSecurityManager template with
+    its own appbuilder, so mock wiring on one test's copy cannot leak
+    into another's.
+
+    oauth_providers is monkeypatched on the class so that tests which
+    shadow it are reverted automatically instead of leaking the value
+    into later tests
+    """
+    monkeypatch.setattr(
+        CustomSecurityManager, "oauth_providers", [], raising=False)
+    manager = copy.copy(csm_template)
+    manager.appbuilder = MagicMock()
+    return manager